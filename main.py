@@ -1,21 +1,48 @@
 import os
 import json
-import datetime
+import hashlib
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any
-from fastapi import FastAPI, Request
-from pydantic import BaseModel
-from twilio.rest import Client
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from fastapi import FastAPI
+from twilio.base.exceptions import TwilioRestException
+from celery import Celery, group
+from celery.signals import worker_process_init
+import redis
+import aiohttp
+from aiogoogle import Aiogoogle
+from aiogoogle.auth.creds import ServiceAccountCreds
+from aiogoogle.excs import HTTPError
+from aiogoogle.sessions.aiohttp_session import AiohttpSession
+from twilio_singleton import get_twilio
+from models import ServiceAreaRequest, EmergencyReport, AvailabilityRequest, BookingRequest
 
-app = FastAPI()
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("plumber")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
 
 # --- CONFIGURATION ---
 TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_FROM = os.getenv("TWILIO_FROM_NUMBER") 
-PLUMBER_CELL = os.getenv("PLUMBER_CELL_PHONE")
-SERVICE_AREA_ZIPS = ["15201", "15202", "15203", "15212", "15213", "15222", "15232"]
+PLUMBER_CELL = os.getenv("PLUMBER_CELL_PHONE")  # comma-separated if more than one tech is on call
+PLUMBER_CELLS = [n.strip() for n in (PLUMBER_CELL or "").split(",") if n.strip()]
+MESSAGING_SERVICE_SID = os.getenv("TWILIO_MSG_SVC_SID")  # optional: send from a pool of numbers
+NOTIFY_SID = os.getenv("TWILIO_NOTIFY_SID")  # optional: fan out to several techs in one API call
+REDIS_URL = os.getenv("REDIS_URL")
+SERVICE_AREA_ZIPS = frozenset({"15201", "15202", "15203", "15212", "15213", "15222", "15232"})
+
+# SMS sent to the plumber, filled from an EmergencyReport
+EMERGENCY_TEMPLATE = (
+    "🚨 NEW EMERGENCY JOB 🚨\n\n"
+    "Issue: {issue_type}\n"
+    "Customer: {customer_name}\n"
+    "Phone: {customer_phone}\n"
+    "Location: {zip_code}\n"
+    "Status: Customer is waiting. Call immediately."
+)
 
 # --- 🚨 CRITICAL CHANGE HERE 🚨 ---
 # Change 'primary' to the Gmail address you shared the calendar with.
@@ -26,30 +53,153 @@ CALENDAR_ID = 'anonymustard123@gmail.com'
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
 creds_dict = json.loads(creds_json) if creds_json else None
-creds = service_account.Credentials.from_service_account_info(creds_dict, scopes=SCOPES) if creds_dict else None
-twilio_client = Client(TWILIO_SID, TWILIO_TOKEN)
+creds = ServiceAccountCreds(scopes=SCOPES, **creds_dict) if creds_dict else None
+# Async client: Calendar calls are awaited instead of blocking the event loop.
+# Each request opens it with `async with aiogoogle:`; the access token is kept between requests.
+_google_session = None
+_calendar_api = None
+GOOGLE_TIMEOUT = 15  # seconds; aiohttp would otherwise wait up to 300 s on a stalled call
+
+# Task queue (run the worker with: celery -A main.celery_app worker)
+# Run exactly ONE worker node (one Railway replica): Celery enforces rate_limit per node,
+# so a second node would double the SMS rate past Twilio's 1 msg/sec long-code limit.
+celery_app = Celery("plumber", broker=REDIS_URL)
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
 
 # --- HELPER FUNCTIONS ---
-def get_google_service():
-    if not creds:
-        print("❌ ERROR: No Google Credentials found.")
+class KeepAliveSession(AiohttpSession):
+    # aiogoogle closes its session after every `async with`; this one stays open until shutdown
+    # so Calendar calls keep reusing the connection to www.googleapis.com
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+def google_session():
+    # The web process shares the session opened in lifespan(). The Celery worker runs each
+    # booking in its own event loop, so it gets a short-lived session per call instead.
+    if _google_session is not None:
+        return _google_session
+    return AiohttpSession()
+
+aiogoogle = Aiogoogle(session_factory=google_session, service_account_creds=creds) if creds else None
+
+@asynccontextmanager
+async def lifespan(app):
+    global _google_session
+    _google_session = KeepAliveSession()
+    yield
+    await _google_session.close()
+    _google_session = None
+
+async def get_calendar_api():
+    # Must be awaited inside `async with aiogoogle:`; the discovery doc is only fetched once
+    global _calendar_api
+    if _calendar_api is None:
+        _calendar_api = await aiogoogle.discover('calendar', 'v3')
+    return _calendar_api
+
+async def insert_event(event_body):
+    async with aiogoogle:
+        calendar_api = await get_calendar_api()
+        return await aiogoogle.as_service_account(
+            calendar_api.events.insert(calendarId=CALENDAR_ID, json=event_body), timeout=GOOGLE_TIMEOUT
+        )
+
+# --- BACKGROUND TASKS ---
+def warm_twilio_connection(client):
+    # Open the DNS+TLS connection to api.twilio.com before the first emergency needs it
+    try:
+        client.api.v2010.accounts(TWILIO_SID).fetch()
+    except Exception as e:
+        logger.warning("⚠️ TWILIO WARMUP FAILED: %s", e)
+
+@worker_process_init.connect
+def start_twilio_warmup(**kwargs):
+    # Build the client here (no network I/O) so the warm-up thread and the first task
+    # can't race to create two of them. Only the fetch runs in the background: Celery kills
+    # a pool process that takes longer than worker_proc_alive_timeout (4 s) to start.
+    client = get_twilio()
+    threading.Thread(target=warm_twilio_connection, args=(client,), daemon=True).start()
+
+@celery_app.task(bind=True, rate_limit="1/s", autoretry_for=(TwilioRestException,), retry_backoff=True, retry_kwargs={"max_retries": 5})
+def send_emergency_sms(self, body, to):
+    # Twilio 429s and outages are retried with backoff instead of failing the Vapi call.
+    # Each task sends exactly one message, so rate_limit caps the worker node at 1 msg/sec.
+    # A Messaging Service spreads sends over its number pool instead of one long code.
+    sender = {"messaging_service_sid": MESSAGING_SERVICE_SID} if MESSAGING_SERVICE_SID else {"from_": TWILIO_FROM}
+    message = get_twilio().messages.create(body=body, to=to, **sender)
+    logger.info("📲 SMS SENT: %s", message.sid)
+    return message.sid
+
+@celery_app.task(bind=True, autoretry_for=(TwilioRestException,), retry_backoff=True, retry_kwargs={"max_retries": 5})
+def notify_emergency_sms(self, body, to):
+    # One Notify call fans the alert out to every on-call number
+    notification = get_twilio().notify.v1.services(NOTIFY_SID).notifications.create(
+        to_binding=[json.dumps({"binding_type": "sms", "address": n}) for n in to],
+        body=body
+    )
+    logger.info("📲 SMS SENT: %s (%d recipients)", notification.sid, len(to))
+    return notification.sid
+
+def dispatch_emergency_sms(body):
+    if len(PLUMBER_CELLS) > 1 and NOTIFY_SID:
+        notify_emergency_sms.delay(body, PLUMBER_CELLS)
+    else:
+        # One task per number, so a retry for one tech never re-texts the others
+        group(send_emergency_sms.s(body, n) for n in PLUMBER_CELLS).apply_async()
+
+class TransientGoogleError(Exception):
+    # A Calendar failure worth retrying: rate limiting, a Google 5xx or a network error
+    pass
+
+def _is_transient(e):
+    if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+        return True
+    status = e.res.status_code if isinstance(e, HTTPError) and e.res is not None else None
+    return status is not None and (status == 429 or status >= 500)
+
+@celery_app.task(bind=True, autoretry_for=(TransientGoogleError,), retry_backoff=True, retry_kwargs={"max_retries": 5})
+def insert_calendar_event(self, event_body, idem_key):
+    # Vapi retries tool calls aggressively; the key turns a repeated booking into a no-op for a day
+    key = f"book:{idem_key}"
+    if redis_client is None:
+        logger.warning("⚠️ REDIS_URL not set; booking %s with only the event-id duplicate check", idem_key)
+    elif not redis_client.set(key, "1", nx=True, ex=86400):
+        logger.info("📝 DUPLICATE BOOKING SKIPPED: %s", idem_key)
         return None
-    return build('calendar', 'v3', credentials=creds)
+    # Google rejects a second insert with the same event id (409), so a retry after a timeout
+    # that actually reached Google can't double-book. Hex digits are valid event-id characters.
+    event_body = {**event_body, 'id': hashlib.sha1(idem_key.encode()).hexdigest()}
+    try:
+        event = asyncio.run(insert_event(event_body))
+    except Exception as e:
+        if isinstance(e, HTTPError) and e.res is not None and e.res.status_code == 409:
+            logger.info("📝 ALREADY BOOKED: %s", idem_key)
+            return event_body['id']
+        # Release the key so the retry (or the caller trying again) can still book
+        if redis_client is not None:
+            redis_client.delete(key)
+        if _is_transient(e):
+            raise TransientGoogleError(str(e)) from e
+        # Permanent errors (bad request, no access to the calendar) fail without retrying
+        raise
+    logger.info("📝 BOOKED: %s", event.get('id'))
+    return event.get('id')
 
 # --- ENDPOINTS ---
+app = FastAPI(lifespan=lifespan)
+
+# The return annotations let FastAPI serialize straight to JSON bytes in pydantic-core
+# instead of going through jsonable_encoder + json.dumps.
 
 @app.get("/")
-def home():
+def home() -> Dict[str, str]:
     return {"status": "Plumber Bot Online 🟢"}
 
 @app.post("/check-service-area")
-async def check_service_area(request: Request):
-    # Flexible handler that prints what Vapi sends
-    body = await request.json()
-    print(f"🔍 DEBUG SERVICE AREA: {body}")
+async def check_service_area(data: ServiceAreaRequest) -> Dict[str, str]:
+    logger.debug("🔍 SERVICE AREA: %s", data)
     
-    # Try to find the zip code in various possible keys
-    zip_code = body.get('zip_code') or body.get('zip') or body.get('code')
+    zip_code = data.zip_code
     
     if not zip_code:
          return {"result": "error", "message": "I didn't hear a zip code."}
@@ -60,72 +210,80 @@ async def check_service_area(request: Request):
         return {"result": "out_of_area", "message": "Unfortunately, we do not service that zip code."}
 
 @app.post("/report-emergency")
-async def report_emergency(request: Request):
-    body = await request.json()
-    print(f"🚨 DEBUG EMERGENCY: {body}")
-    
-    # Extract data safely
-    issue = body.get('issue_type', 'Emergency')
-    phone = body.get('customer_phone', 'Unknown')
+async def report_emergency(data: EmergencyReport) -> Dict[str, str]:
+    logger.info("🚨 EMERGENCY issue=%s customer=%s", data.issue_type, data.customer_name)
     
-    print(f"📲 [MOCK SMS] To Conrad: {issue} - {phone}")
+    if not PLUMBER_CELLS:
+        logger.error("❌ DISPATCH ERROR: PLUMBER_CELL_PHONE is not set")
+        return {"status": "error", "message": "I was unable to alert the dispatcher."}
+
+    sms_body = EMERGENCY_TEMPLATE.format_map(data.model_dump())
+    try:
+        await asyncio.to_thread(dispatch_emergency_sms, sms_body)
+    except Exception as e:
+        logger.error("❌ DISPATCH ERROR: %s", e)
+        return {"status": "error", "message": "I was unable to alert the dispatcher."}
     return {"status": "success", "message": "Dispatcher alerted."}
 
 @app.post("/check-availability")
-async def check_availability(request: Request):
-    # 1. Capture the raw input from Vapi to debug the 422 error
-    body = await request.json()
-    print(f"📅 DEBUG CALENDAR CHECK: {body}")
+async def check_availability(data: AvailabilityRequest) -> Dict[str, str]:
+    # 1. Log what Vapi sent
+    logger.debug("📅 CALENDAR CHECK: %s", data)
 
-    service = get_google_service()
-    if not service:
+    if not aiogoogle:
+        logger.error("❌ No Google Credentials found.")
         return {"status": "error", "message": "Calendar system offline."}
     
     # 2. Check the Calendar
-    now = datetime.datetime.utcnow().isoformat() + 'Z'
+    now = datetime.now(timezone.utc)
     try:
-        events_result = service.events().list(
-            calendarId=CALENDAR_ID, 
-            timeMin=now,
-            maxResults=10, 
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
+        # FreeBusy returns only the busy intervals, not full event objects
+        async with aiogoogle:
+            calendar_api = await get_calendar_api()
+            freebusy_result = await aiogoogle.as_service_account(calendar_api.freebusy.query(json={
+                "timeMin": now.isoformat(timespec='seconds'),
+                "timeMax": (now + timedelta(hours=48)).isoformat(timespec='seconds'),
+                "items": [{"id": CALENDAR_ID}]
+            }))
+        calendar = freebusy_result['calendars'][CALENDAR_ID]
+        if calendar.get('errors'):
+            # e.g. the calendar isn't shared with the service account; don't report it as free
+            raise RuntimeError(calendar['errors'])
+        busy = calendar.get('busy', [])
         
-        if not events:
+        if not busy:
             return {"status": "free", "message": "I am completely wide open for the next 2 days."}
         
         # Format the busy times clearly for the AI
-        busy_list = []
-        for e in events:
-            start = e['start'].get('dateTime', e['start'].get('date'))
-            summary = e.get('summary', 'Busy')
-            busy_list.append(f"{start} ({summary})")
+        busy_list = [f"{b['start']} to {b['end']}" for b in busy]
             
         busy_string = ", ".join(busy_list)
         return {"status": "busy", "message": f"I have appointments at: {busy_string}"}
         
     except Exception as e:
-        print(f"❌ CALENDAR ERROR: {e}")
+        logger.error("❌ CALENDAR ERROR: %s", e)
         return {"status": "error", "message": "I am having trouble accessing the schedule right now."}
 
 @app.post("/book-appointment")
-async def book_appointment(request: Request):
-    body = await request.json()
-    print(f"📝 DEBUG BOOKING: {body}")
-    
-    service = get_google_service()
+async def book_appointment(data: BookingRequest) -> Dict[str, str]:
+    logger.debug("📝 BOOKING: %s", data)
     
-    customer_name = body.get('customer_name', 'Unknown')
-    start_time = body.get('start_time')
+    customer_name = data.customer_name or data.customer_phone
+    start_time = data.start_time
     
     if not start_time:
         return {"status": "error", "message": "I need a valid start time."}
 
+    if not customer_name:
+        return {"status": "error", "message": "I need the customer's name or phone number."}
+
+    if not aiogoogle:
+        logger.error("❌ No Google Credentials found.")
+        return {"status": "error", "message": "Calendar system offline."}
+
     try:
-        start_dt = datetime.datetime.fromisoformat(start_time.replace("Z", "+00:00"))
-        end_dt = start_dt + datetime.timedelta(hours=1)
+        start_dt = datetime.fromisoformat(start_time)  # accepts a trailing 'Z' on Python 3.11+
+        end_dt = start_dt + timedelta(hours=1)
         
         event_body = {
             'summary': f"PLUMBING: {customer_name}",
@@ -134,8 +292,11 @@ async def book_appointment(request: Request):
             'end': {'dateTime': end_dt.isoformat(), 'timeZone': 'UTC'},
         }
         
-        service.events().insert(calendarId=CALENDAR_ID, body=event_body).execute()
+        # Key on the instant in UTC so 'Z', '+00:00' or no offset (treated as UTC) all match
+        slot = start_dt if start_dt.tzinfo else start_dt.replace(tzinfo=timezone.utc)
+        idem_key = f"{data.customer_phone or data.customer_name}:{slot.astimezone(timezone.utc).isoformat()}"
+        await asyncio.to_thread(insert_calendar_event.delay, event_body, idem_key)
         return {"status": "success", "message": "Appointment confirmed."}
     except Exception as e:
-        print(f"❌ BOOKING ERROR: {e}")
+        logger.error("❌ BOOKING ERROR: %s", e)
         return {"status": "error", "message": "Failed to book slot."}
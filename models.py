@@ -0,0 +1,45 @@
+from typing import Any, Optional
+from pydantic import BaseModel, ConfigDict, ValidationInfo, field_validator, model_validator
+
+# Request bodies sent by the Vapi tools. Every field has a default so a
+# missing value gets a friendly reply from the handler instead of a 422.
+
+class VapiRequest(BaseModel):
+    # Vapi sends numbers (phones, ZIPs) as JSON numbers and empty answers as null
+    model_config = ConfigDict(extra="ignore", frozen=True, coerce_numbers_to_str=True)
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def _lenient(cls, value: Any, info: ValidationInfo) -> Any:
+        # Null falls back to the field default; numbers are handled by coerce_numbers_to_str
+        if value is None:
+            return cls.model_fields[info.field_name].default
+        return value
+
+class ServiceAreaRequest(VapiRequest):
+    zip_code: Optional[str] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def _find_zip(cls, data: Any) -> Any:
+        # Vapi has sent the ZIP under each of these keys; use the first one with a value
+        if isinstance(data, dict):
+            zip_code = data.get("zip_code") or data.get("zip") or data.get("code")
+            return {**data, "zip_code": zip_code}
+        return data
+
+class EmergencyReport(VapiRequest):
+    issue_type: str = "Emergency"
+    customer_name: str = "Unknown"
+    customer_phone: str = "Unknown"
+    zip_code: str = "Unknown"
+
+class AvailabilityRequest(VapiRequest):
+    # No fields are needed yet; keep whatever Vapi sends for the debug log
+    model_config = ConfigDict(extra="allow")
+
+class BookingRequest(VapiRequest):
+    # No "Unknown" defaults: the booking handler needs a real name or phone for its idempotency key
+    customer_name: Optional[str] = None
+    customer_phone: Optional[str] = None
+    start_time: Optional[str] = None
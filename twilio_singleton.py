@@ -0,0 +1,14 @@
+import os
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+
+@lru_cache(maxsize=1)
+def get_twilio() -> Client:
+    # One client per process so every SMS reuses the same keep-alive pool to api.twilio.com.
+    # Built lazily, so each Celery worker process opens its own connections after the fork.
+    # A bounded timeout so a stalled Twilio call fails (and is retried) instead of hanging a worker
+    http_client = TwilioHttpClient(timeout=10)
+    http_client.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=2))
+    return Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"), http_client=http_client)